@@ -1,22 +1,36 @@
 
 
 import requests
+import os
 import csv
 import time
+import random
 import datetime
 import logging
-import pytz
+import threading
+import queue
+import atexit
+import functools
+import io
+import json
+import bisect
+import collections
+import calendar
+from array import array
+from zoneinfo import ZoneInfo
 from astral import LocationInfo
 from astral.sun import sun
 from xml.etree import ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
 # --- Configuration ---
 LOGIN_URL = "https://neapi.hoymiles.com/iam/pub/0/auth/login"
 TOGGLE_URL = "https://neapi.hoymiles.com/pvm-ctl/api/0/dev/command/put"
 STATUS_URL = "https://neapi.hoymiles.com/pvm-ctl/api/0/dev/command/put_status"
+ENTSOE_URL = "https://web-api.tp.entsoe.eu/api"
 
 # INVERTER_CSV: "inverter_data.csv" file contains the Hoymiles user credentials in the following format 
 # (first line is a comment line)
@@ -31,14 +45,35 @@ ENTSOE_TOKEN = "ADD_YOUR_TOKEN_HERE"
 # "10YNL----------L" refers to the day-ahead electricity prices in the Netherlands 
 ENTSOE_DOMAIN = "10YNL----------L"
 
+# PRICE_MARGIN: [EUR/kWh] margin added to the price before deciding its sign, i.e. solar panels are turned off
+# only when the price drops below -PRICE_MARGIN
+PRICE_MARGIN = 0.01
+
+# MAX_PARALLEL_INVERTERS: number of inverters that are logged in, toggled and checked at the same time
+MAX_PARALLEL_INVERTERS = 8
+
+# CONNECT_TIMEOUT, READ_TIMEOUT: [s] limits for every HTTP request, so a stalled connection cannot hang the loop.
+# Status polls use the shorter STATUS_TIMEOUT because they run within the 60 s budget of a command
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 10
+STATUS_TIMEOUT = (3, 5)
+
+# API_RATE_LIMIT: [requests/s] maximum rate of requests to the Hoymiles API, shared by all inverters
+API_RATE_LIMIT = 2.0
+
 # Logging setup: weekly rotating log, 4 backups, no console output
+# Records are queued and written to the file by a listener thread, so logging never blocks on disk I/O
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 log_handler = TimedRotatingFileHandler("hoymiles_price_controller_log.log", when="W0", backupCount=4, encoding="utf-8")
 formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 log_handler.setFormatter(formatter)
-logger.addHandler(log_handler)
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, log_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger.addHandler(QueueHandler(log_queue))
 
 HEADERS = {
     "Content-Type": "application/json; charset=UTF-8",
@@ -49,92 +84,191 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0"
 }
 
-nl_tz = pytz.timezone("Europe/Amsterdam")
+nl_tz = ZoneInfo("Europe/Amsterdam")
+CITY = LocationInfo("Amsterdam", "Netherlands", "Europe/Amsterdam", 52.3676, 4.9041)
 
-def create_session():
+def create_session(headers=None):
     session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    # short backoff (0.5, 1, 2 s plus jitter): long waits hurt more than a few extra retries in a control loop
     retries = Retry(
-        total=5,
-        backoff_factor=2,
+        total=3,
+        backoff_factor=0.5,
+        backoff_jitter=0.3,
         status_forcelist=[500, 502, 503, 504],
         allowed_methods=["HEAD", "GET", "OPTIONS", "POST"],
         raise_on_status=False,
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=4, pool_maxsize=32, pool_block=False)
     session.mount("https://", adapter)
     session.mount("http://", adapter)
     return session
 
-SESSION = create_session()
+# SESSION talks to the Hoymiles API and carries its headers, ENTSOE_SESSION fetches the day-ahead prices
+SESSION = create_session(HEADERS)
+ENTSOE_SESSION = create_session()
+
+def warm_up_sessions():
+    # resolve DNS and open the keep-alive connections before the first real request
+    for session, url in ((SESSION, LOGIN_URL), (ENTSOE_SESSION, ENTSOE_URL)):
+        try:
+            session.head(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not warm up connection to {url}: {e}")
+
+class TokenBucket:
+    # Thread-safe token bucket: a request proceeds immediately while tokens are left, otherwise it waits for the refill
+    def __init__(self, rate_per_s):
+        self.rate = rate_per_s
+        self.tokens = rate_per_s
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1  # reserve a token, a negative balance is the wait of this request
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_seconds:
+            time.sleep(wait_seconds)
+
+API_BUCKET = TokenBucket(rate_per_s=API_RATE_LIMIT)
+
+# Set on Ctrl+C so worker threads that have not started yet do not send their command
+_SHUTDOWN = threading.Event()
+
+# Static part of the ENTSO-E day-ahead price request, only the period changes per call
+ENTSOE_PARAMS = {
+    "securityToken": ENTSOE_TOKEN,
+    "documentType": "A44",
+    "in_Domain": ENTSOE_DOMAIN,
+    "out_Domain": ENTSOE_DOMAIN,
+}
+
+# Day-ahead prices do not change during the day: keep them per local date until the next midnight.
+# Prices are stored as parallel arrays: hour starts (epoch seconds, sorted), EUR/kWh prices and a sign mask
+# holding 1 where the price plus PRICE_MARGIN is non-negative and 0 where it is negative.
+# The ETag/Last-Modified of the response are kept with them, so a later fetch on the same day is a conditional GET
+_PRICE_CACHE = {}
 
 def get_all_prices_for_today():
     now = datetime.datetime.now(nl_tz)
+    today = now.date()
+    cached = _PRICE_CACHE.get(today)
+    if cached and cached[1] > now:
+        return cached[0]
+
     today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
     today_end = today_start + datetime.timedelta(days=1)
 
-    period_start = today_start.strftime("%Y%m%d%H%M")
-    period_end = today_end.strftime("%Y%m%d%H%M")
-
-    url = "https://web-api.tp.entsoe.eu/api"
     params = {
-        "securityToken": ENTSOE_TOKEN,
-        "documentType": "A44",
-        "in_Domain": ENTSOE_DOMAIN,
-        "out_Domain": ENTSOE_DOMAIN,
-        "periodStart": period_start,
-        "periodEnd": period_end,
+        **ENTSOE_PARAMS,
+        "periodStart": today.strftime("%Y%m%d") + "0000",
+        "periodEnd": today_end.strftime("%Y%m%d") + "0000",
     }
 
+    headers = {}
+    if cached:
+        etag, last_modified = cached[2]
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
     try:
-        response = SESSION.get(url, params=params)
+        response = ENTSOE_SESSION.get(ENTSOE_URL, params=params, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to fetch ENTSO-E data: {e}")
-        return []
+        return None
+
+    if response.status_code == 304 and cached:
+        # prices have not changed upstream: reuse the parsed ones
+        _PRICE_CACHE[today] = (cached[0], today_end, cached[2])
+        return cached[0]
+    validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
 
     try:
-        root = ET.fromstring(response.content)
-        prices = []
-        for time_series in root.findall(".//{*}TimeSeries"):
-            period = time_series.find(".//{*}Period")
-            start_time_str = period.find("{*}timeInterval/{*}start").text
-            start_time = datetime.datetime.strptime(start_time_str, "%Y-%m-%dT%H:%MZ").replace(tzinfo=pytz.utc).astimezone(nl_tz)
-
-            for point in period.findall("{*}Point"):
-                position = int(point.find("{*}position").text)
-                price_eur_per_mwh = float(point.find("{*}price.amount").text)
-                hour = start_time + datetime.timedelta(hours=position - 1)
-                prices.append((hour, price_eur_per_mwh / 1000.0))  # EUR/kWh
-
-        return prices
+        # Stream the document in a single pass: the start time, position and price are picked up from the
+        # end events of their own elements, and every Point and TimeSeries is freed once it has been read
+        points = []
+        root = None
+        start_epoch = position = price_eur_per_mwh = None
+        for event, elem in ET.iterparse(io.BytesIO(response.content), events=("start", "end")):
+            if root is None:
+                # the first event opens the root element: look up tags in the document's own namespace
+                root = elem
+                q = elem.tag[:elem.tag.index("}") + 1] if elem.tag.startswith("{") else ""
+                start_tag, position_tag, price_tag = q + "start", q + "position", q + "price.amount"
+                point_tag, series_tag = q + "Point", q + "TimeSeries"
+                continue
+            if event != "end":
+                continue
+
+            tag = elem.tag
+            if tag == position_tag:
+                position = int(elem.text)
+            elif tag == price_tag:
+                price_eur_per_mwh = float(elem.text)
+            elif tag == point_tag:
+                points.append((start_epoch + 3600 * (position - 1), price_eur_per_mwh / 1000.0))  # EUR/kWh
+                position = price_eur_per_mwh = None
+                elem.clear()
+            elif tag == start_tag:
+                # the Period's timeInterval/start (UTC, e.g. "2024-05-10T22:00Z") precedes its Points
+                start_str = elem.text
+                start_epoch = calendar.timegm((int(start_str[0:4]), int(start_str[5:7]), int(start_str[8:10]),
+                                               int(start_str[11:13]), int(start_str[14:16]), 0))
+            elif tag == series_tag:
+                root.clear()
     except Exception as e:
         logger.exception("Error parsing ENTSO-E XML response")
-        return []
+        return None
+
+    _PRICE_CACHE.clear()  # evict entries of previous days
+    if not points:
+        return None
+    points.sort()
+    values = array("d", (price for _, price in points))
+    signs = bytes(price + PRICE_MARGIN >= 0 for price in values)
+    prices = (array("q", (hour for hour, _ in points)), values, signs)
+    _PRICE_CACHE[today] = (prices, today_end, validators)
+    return prices
+
+def invalidate_price_cache():
+    # expire the cached prices but keep their validators, so the next fetch can still be answered with a 304
+    now = datetime.datetime.now(nl_tz)
+    for day, (prices, _, validators) in list(_PRICE_CACHE.items()):
+        _PRICE_CACHE[day] = (prices, now, validators)
 
 def find_current_price_block(prices):
+    hours, _, signs = prices
     now = datetime.datetime.now(nl_tz).replace(minute=0, second=0, microsecond=0)
-    current_index = next((i for i, (hour, _) in enumerate(prices) if hour == now), None)
-    if current_index is None:
+    now_epoch = int(now.timestamp())
+    current_index = bisect.bisect_left(hours, now_epoch)
+    if current_index == len(hours) or hours[current_index] != now_epoch:
         return None, 0, now
 
-    price_margin = 0.01  # [EUR/kWh] add margin in the price before turning solar panels off
-    current_sign = 1 if prices[current_index][1]+price_margin >= 0 else -1
-    block_hours = [prices[current_index][0]]
-
-    for hour, price in prices[current_index + 1:]:
-        if (price+price_margin >= 0) == (current_sign > 0):
-            block_hours.append(hour)
-        else:
-            break
+    current_sign = 1 if signs[current_index] else -1
+    # the block ends at the first hour with the opposite sign
+    block_end = signs.find(signs[current_index] ^ 1, current_index + 1)
+    if block_end == -1:
+        block_end = len(signs)
+    block_length = block_end - current_index
 
-    return current_sign, len(block_hours), prices[current_index + len(block_hours) - 1][0]
+    last_hour = datetime.datetime.fromtimestamp(hours[current_index + block_length - 1], nl_tz)
+    return current_sign, block_length, last_hour
 
 def login(username, encrypted_password):
     payload = {"user_name": username, "password": encrypted_password}
     try:
-        response = SESSION.post(LOGIN_URL, headers=HEADERS, json=payload)
+        API_BUCKET.acquire()
+        response = SESSION.post(LOGIN_URL, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
         response.raise_for_status()
-        data = response.json()
+        data = json.loads(response.content)
     except Exception as e:
         logger.warning(f"Login error for {username}: {e}")
         return None
@@ -144,9 +278,32 @@ def login(username, encrypted_password):
     logger.warning(f"Login failed for {username}: {data.get('message')}")
     return None
 
-def toggle_inverter(token, dtu_sn, inverter_sn, action):
-    headers = HEADERS.copy()
-    headers["authorization"] = token
+# Hoymiles tokens stay valid for hours: reuse them per username instead of logging in every cycle.
+# Each token is kept on its own session, which sends it as authorization header with every request
+TOKEN_TTL = 3600  # [s]
+_TOKEN_CACHE = {}
+
+class TokenRejected(Exception):
+    pass
+
+def get_user_session(username, encrypted_password):
+    session, expiry = _TOKEN_CACHE.get(username, (None, 0))
+    if session and time.monotonic() < expiry:
+        return session
+    token = login(username, encrypted_password)
+    if not token:
+        return None
+    session = create_session(HEADERS)
+    session.headers["authorization"] = token
+    _TOKEN_CACHE[username] = (session, time.monotonic() + TOKEN_TTL)
+    return session
+
+def invalidate_token(username):
+    session, _ = _TOKEN_CACHE.pop(username, (None, 0))
+    if session:
+        session.close()
+
+def toggle_inverter(session, dtu_sn, inverter_sn, action):
     payload = {
         "action": action,
         "dev_sn": inverter_sn,
@@ -154,35 +311,39 @@ def toggle_inverter(token, dtu_sn, inverter_sn, action):
         "dtu_sn": dtu_sn
     }
     try:
-        response = SESSION.post(TOGGLE_URL, headers=headers, json=payload)
+        API_BUCKET.acquire()
+        response = session.post(TOGGLE_URL, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        if response.status_code in (401, 403):
+            raise TokenRejected(f"HTTP {response.status_code}")
         response.raise_for_status()
-        data = response.json()
+        data = json.loads(response.content)
         if data.get("status") == "0":
             return data["data"]
+    except TokenRejected:
+        raise
     except Exception as e:
         logger.error(f"Toggle error: {e}")
     return None
 
-def check_status(token, command_id):
-    headers = HEADERS.copy()
-    headers["authorization"] = token
-    payload = {"id": command_id}
-
-    for _ in range(60):
-        try:
-            response = SESSION.post(STATUS_URL, headers=headers, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            if data.get("status") == "0" and data["data"].get("code") == 0:
-                logger.info("✅ Inverter responded to command successfully.")
-                return True
-        except Exception as e:
-            logger.warning(f"Error checking status: {e}")
-        time.sleep(1)
-    logger.warning("❌ Inverter did not respond within timeout.")
+def check_status(session, body):
+    try:
+        API_BUCKET.acquire()
+        response = session.post(STATUS_URL, data=body, timeout=STATUS_TIMEOUT)
+        response.raise_for_status()
+        data = json.loads(response.content)
+        return data.get("status") == "0" and data["data"].get("code") == 0
+    except Exception as e:
+        logger.warning(f"Error checking status: {e}")
     return False
 
+# INVERTER_CSV is only parsed again when its modification time changes
+_INV_CACHE = {"mtime": None, "inverters": []}
+
 def load_inverters():
+    mtime = os.stat(INVERTER_CSV).st_mtime
+    if mtime == _INV_CACHE["mtime"]:
+        return _INV_CACHE["inverters"]
+
     inverters = []
     with open(INVERTER_CSV, newline="") as csvfile:
         reader = csv.reader(csvfile)
@@ -198,26 +359,122 @@ def load_inverters():
                 "dtu_sn": row[3],
                 "inverter_sn": row[4]
             })
+    _INV_CACHE["mtime"] = mtime
+    _INV_CACHE["inverters"] = inverters
     return inverters
 
+def send_command(inv, action_code):
+    if _SHUTDOWN.is_set():
+        return None
+    logger.info(f"Send {action_code} (6 = ON, 7 = OFF) to inverter {inv['inverter_sn']} for user {inv['username']}...")
+    for _ in range(2):
+        session = get_user_session(inv["username"], inv["password"])
+        if not session:
+            return None
+        try:
+            command_id = toggle_inverter(session, inv["dtu_sn"], inv["inverter_sn"], action_code)
+            break
+        except TokenRejected as e:
+            # cached token is no longer accepted: log in again and retry once
+            logger.warning(f"Token rejected for {inv['username']} ({e}). Logging in again...")
+            invalidate_token(inv["username"])
+    else:
+        return None
+    if not command_id:
+        return None
+    return session, command_id
+
+def check_command_statuses(futures):
+    # Commands are polled from a single LIFO stack: whenever several are due, the most recently queued one gets the
+    # next poll, so stalled commands resolve (or time out) one after another instead of polling the API in lockstep.
+    # Each command is polled with exponential backoff (0.2 s growing to 4 s) within a 60 s budget
+    any_failure = False
+    pending = set(futures)
+    stack = collections.deque()
+    while pending or stack:
+        now = time.monotonic()
+        for future in [f for f in pending if f.done()]:
+            pending.remove(future)
+            inv = futures[future]
+            try:
+                command = future.result()
+            except Exception:
+                logger.exception(f"Unexpected error for inverter {inv['inverter_sn']}")
+                command = None
+            if not command:
+                any_failure = True
+                continue
+            session, command_id = command
+            stack.append({
+                "inverter_sn": inv["inverter_sn"],
+                "session": session,
+                "body": json.dumps({"id": command_id}),  # serialized once, posted on every poll
+                "next_poll": now,
+                "delay": 0.2,
+                "deadline": now + 60
+            })
+
+        entry = next((e for e in reversed(stack) if e["next_poll"] <= now), None)
+        if entry is None:
+            timeout = min(e["next_poll"] for e in stack) - now if stack else None
+            if pending:
+                wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
+            continue
+
+        stack.remove(entry)
+        if check_status(entry["session"], entry["body"]):
+            logger.info(f"✅ Inverter {entry['inverter_sn']} responded to command successfully.")
+        elif time.monotonic() >= entry["deadline"]:
+            logger.warning(f"❌ Inverter {entry['inverter_sn']} did not respond within timeout.")
+            any_failure = True
+        else:
+            delay = entry["delay"]
+            entry["next_poll"] = time.monotonic() + delay + random.uniform(0, delay * 0.2)
+            entry["delay"] = min(delay * 1.7, 4.0)
+            stack.append(entry)
+    return any_failure
+
+def toggle_all_inverters(inverters, action_code):
+    # logins and toggles run in the worker threads, the status of the sent commands is polled from this thread
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_INVERTERS) as executor:
+        futures = {executor.submit(send_command, inv, action_code): inv for inv in inverters}
+        try:
+            return check_command_statuses(futures)
+        except KeyboardInterrupt:
+            _SHUTDOWN.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+@functools.lru_cache(maxsize=2)
+def sun_table(year):
+    # (sunrise, sunset) of every day of the year, indexed by day of the year - 1 and built once per year
+    table = []
+    day = datetime.date(year, 1, 1)
+    while day.year == year:
+        s = sun(CITY.observer, date=day, tzinfo=nl_tz)
+        table.append((s["sunrise"], s["sunset"]))
+        day += datetime.timedelta(days=1)
+    return table
+
+def sun_for(date):
+    return sun_table(date.year)[date.timetuple().tm_yday - 1]
+
 def wait_until_sunrise():
-    city = LocationInfo("Amsterdam", "Netherlands", "Europe/Amsterdam", 52.3676, 4.9041)
     now = datetime.datetime.now(nl_tz)
-    s = sun(city.observer, date=now.date(), tzinfo=nl_tz)
-    sunrise = s["sunrise"]
+    sunrise, _ = sun_for(now.date())
     if now >= sunrise:
-        s = sun(city.observer, date=now.date() + datetime.timedelta(days=1), tzinfo=nl_tz)
-        sunrise = s["sunrise"]
+        sunrise, _ = sun_for(now.date() + datetime.timedelta(days=1))
 
     wait_seconds = (sunrise - now).total_seconds()
     logger.info(f"Sleeping until sunrise at {sunrise} ({int(wait_seconds)} seconds)...")
     time.sleep(wait_seconds)
 
 def is_daylight():
-    city = LocationInfo("Amsterdam", "Netherlands", "Europe/Amsterdam", 52.3676, 4.9041)
     now = datetime.datetime.now(nl_tz)
-    s = sun(city.observer, date=now.date(), tzinfo=nl_tz)
-    return s["sunrise"] <= now <= s["sunset"]
+    sunrise, sunset = sun_for(now.date())
+    return sunrise <= now <= sunset
 
 def main_loop():
     while True:
@@ -234,6 +491,8 @@ def main_loop():
 
         sign, duration, last_hour = find_current_price_block(prices)
         if sign is None or duration == 0:
+            # cached prices no longer cover the current hour (e.g. DST rollover): fetch them again
+            invalidate_price_cache()
             logger.warning("Could not determine price block. Retrying in 5 minutes.")
             time.sleep(300)
             continue
@@ -242,21 +501,7 @@ def main_loop():
         logger.info(f"💡 Current price block is {'positive' if sign > 0 else 'negative'} for {duration} hour(s).")
 
         inverters = load_inverters()
-        any_failure = False
-        for inv in inverters:
-            logger.info(f"Send {action_code} (6 = ON, 7 = OFF) to inverter {inv['inverter_sn']} for user {inv['username']}...")
-            token = login(inv["username"], inv["password"])
-            if not token:
-                any_failure = True
-                continue
-            command_id = toggle_inverter(token, inv["dtu_sn"], inv["inverter_sn"], action_code)
-            if command_id:
-                success = check_status(token, command_id)
-                if not success:
-                    any_failure = True
-            else:
-                any_failure = True
-            time.sleep(1.5)
+        any_failure = toggle_all_inverters(inverters, action_code)
 
         if any_failure:
             logger.warning("⚠️ One or more inverters failed. Sleeping for 15 minutes.")
@@ -275,6 +520,7 @@ if __name__ == "__main__":
         logger.info("!!!!!!!!!!Script restarted!!!!!!!!!!!!!!!")
         logger.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         logger.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        warm_up_sessions()
         main_loop()
     except KeyboardInterrupt:
         logger.info("🚪 Script interrupted by user (Ctrl+C). Exiting gracefully.")